@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import datetime
+import unittest
+import zipfile
+
+from zipstreamer import ZipStream, ZipFile, ZipFileSkip
+from zipstreamer.compat import BytesIO
+from zipstreamer.wsgi import etag_matches, wsgi_response
+
+
+class TestWsgi(unittest.TestCase):
+    def create_zip_stream(self):
+        return ZipStream(files=[
+            ZipFile('file.txt', 4, lambda: BytesIO(b'test'), datetime.datetime(2008, 11, 10, 17, 53, 59), None, 3632233996),
+        ])
+
+    def call(self, z, environ, no_skip=True):
+        responses = []
+
+        def start_response(status, headers):
+            responses.append((status, dict(headers)))
+
+        body = b''.join(wsgi_response(z, environ, start_response, no_skip=no_skip))
+
+        self.assertEqual(len(responses), 1)
+
+        return responses[0][0], responses[0][1], body
+
+    def test_etag_matches(self):
+        self.assertTrue(etag_matches('"a"', '"a"'))
+        self.assertTrue(etag_matches('"b", W/"a"', '"a"'))
+        self.assertTrue(etag_matches('*', '"a"'))
+        self.assertFalse(etag_matches('"b"', '"a"'))
+        self.assertFalse(etag_matches(None, '"a"'))
+
+    def test_ok(self):
+        z = self.create_zip_stream()
+
+        status, headers, body = self.call(z, {'REQUEST_METHOD': 'GET'})
+
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers['ETag'], z.etag())
+        self.assertEqual(headers['Content-Type'], 'application/zip')
+        self.assertEqual(headers['Content-Length'], str(len(body)))
+        self.assertEqual(body, b''.join(z.generate()))
+
+    def test_not_modified(self):
+        z = self.create_zip_stream()
+
+        status, headers, body = self.call(z, {
+            'REQUEST_METHOD': 'GET',
+            'HTTP_IF_NONE_MATCH': z.etag(),
+        })
+
+        self.assertEqual(status, '304 Not Modified')
+        self.assertEqual(headers['ETag'], z.etag())
+        self.assertNotIn('Content-Length', headers)
+        self.assertEqual(body, b'')
+
+    def test_not_modified_close(self):
+        f = BytesIO(b'test')
+
+        z = ZipStream(files=[
+            ZipFile('file.txt', 4, lambda: f, datetime.datetime(2008, 11, 10, 17, 53, 59), None, 3632233996),
+        ]).preflight(keep=1)
+
+        status, _, _ = self.call(z, {
+            'REQUEST_METHOD': 'GET',
+            'HTTP_IF_NONE_MATCH': z.etag(),
+        })
+
+        self.assertEqual(status, '304 Not Modified')
+        self.assertTrue(f.closed)
+
+    def test_head(self):
+        z = self.create_zip_stream()
+
+        status, headers, body = self.call(z, {'REQUEST_METHOD': 'HEAD'})
+
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers['Content-Length'], str(z.size()))
+        self.assertEqual(body, b'')
+
+    def test_head_close(self):
+        f = BytesIO(b'test')
+
+        z = ZipStream(files=[
+            ZipFile('file.txt', 4, lambda: f, None, None),
+        ]).preflight(keep=1)
+
+        status, _, body = self.call(z, {'REQUEST_METHOD': 'HEAD'})
+
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(body, b'')
+        self.assertTrue(f.closed)
+
+    def test_skip(self):
+        def skip():
+            raise ZipFileSkip()
+
+        z = ZipStream(files=[
+            ZipFile('file.txt', 4, lambda: BytesIO(b'test'), datetime.datetime(2008, 11, 10, 17, 53, 59), None, 3632233996),
+            ZipFile('skip.txt', 4, skip, datetime.datetime(2008, 11, 10, 17, 53, 59), None, 3632233996),
+        ])
+
+        status, headers, body = self.call(z, {
+            'REQUEST_METHOD': 'GET',
+            'HTTP_IF_NONE_MATCH': z.etag(),
+        }, no_skip=False)
+
+        self.assertEqual(status, '200 OK')
+        self.assertNotIn('ETag', headers)
+        self.assertNotIn('Content-Length', headers)
+        self.assertEqual(len(zipfile.ZipFile(BytesIO(body)).infolist()), 1)
+
+    def test_no_etag(self):
+        z = ZipStream(files=[
+            ZipFile('file.txt', 4, lambda: BytesIO(b'test'), None, None),
+        ])
+
+        status, headers, body = self.call(z, {'REQUEST_METHOD': 'GET'})
+
+        self.assertEqual(status, '200 OK')
+        self.assertNotIn('ETag', headers)
+        self.assertEqual(headers['Content-Length'], str(len(body)))
+
+    def test_preflight_skip(self):
+        def skip():
+            raise ZipFileSkip()
+
+        z = ZipStream(files=[
+            ZipFile('file.txt', 4, lambda: BytesIO(b'test'), datetime.datetime(2008, 11, 10, 17, 53, 59), None, 3632233996),
+            ZipFile('skip.txt', 4, skip, datetime.datetime(2008, 11, 10, 17, 53, 59), None, 3632233996),
+        ]).preflight()
+
+        status, headers, body = self.call(z, {'REQUEST_METHOD': 'GET'}, no_skip=False)
+
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers['ETag'], z.etag())
+        self.assertEqual(headers['Content-Length'], str(len(body)))
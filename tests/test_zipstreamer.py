@@ -5,12 +5,21 @@
 from __future__ import unicode_literals
 
 import datetime
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 import zipfile
+import zlib
 
 from zipstreamer import (
-    ZipStream, ZipFile, FileNameTooLong, ZipFileSizeRequired,
-    ZipFileInProgress, ZipFileSkip
+    ZipStream, ZipFile, SourceScheduler, SourceCache, RateLimiter,
+    FileNameTooLong,
+    ZipFileSizeRequired,
+    ZipFileSkip, ZipFileVersionRequired, ZipFileSizeMismatch, archive_entries,
+    ZipFileDatetimeRequired, imap_unordered
 )
 from zipstreamer.compat import BytesIO, IS_PY2
 
@@ -33,6 +42,55 @@ class DummyFile(object):
         return self.buf
 
 
+def wait_until(predicate, timeout=5):
+    deadline = time.time() + timeout
+
+    while not predicate():
+        if time.time() > deadline:
+            raise AssertionError('Timed out waiting for condition')
+
+        time.sleep(0.001)
+
+
+def skip():
+    raise ZipFileSkip()
+
+
+class FileCounter(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = []
+        self.opened = 0
+        self.closed = 0
+        self.max_open = 0
+
+    def create_fp(self, data):
+        return lambda: CountingFile(self, data)
+
+    def open_files(self):
+        with self.lock:
+            return self.opened - self.closed
+
+
+class CountingFile(BytesIO):
+    def __init__(self, counter, data):
+        BytesIO.__init__(self, data)
+        self.counter = counter
+
+        with counter.lock:
+            counter.calls.append(data)
+            counter.opened += 1
+            counter.max_open = max(counter.max_open,
+                                   counter.opened - counter.closed)
+
+    def close(self):
+        if not self.closed:
+            with self.counter.lock:
+                self.counter.closed += 1
+
+        BytesIO.close(self)
+
+
 class TestZipStream(unittest.TestCase):
     maxDiff = None
 
@@ -184,9 +242,6 @@ class TestZipStream(unittest.TestCase):
                 pass
 
     def test_skip(self):
-        def skip():
-            raise ZipFileSkip()
-
         z = ZipStream(files=[
             ZipFile('file.txt', 4, lambda: BytesIO(b'test'), datetime.datetime(2008, 11, 10, 17, 53, 59), None),
             ZipFile('dir/', None, None, datetime.datetime(2011, 4, 16, 6, 24, 31), None),
@@ -219,22 +274,844 @@ class TestZipStream(unittest.TestCase):
         ])
 
         it = iter(z.generate())
-        next(it)
+        first = next(it)
 
-        with self.assertRaises(ZipFileInProgress):
-            z.size()
+        size = z.size()
+
+        data = first + b''.join(it)
+
+        self.assertEqual(size, len(data))
 
     def test_generate_while_generate(self):
         z = ZipStream(files=[
-            ZipFile('file.txt', 4, lambda: BytesIO(b'test'), None, None),
+            ZipFile('file.txt', 4, lambda: BytesIO(b'test'), datetime.datetime(2008, 11, 10, 17, 53, 59), None),
+            ZipFile('dir/', None, None, datetime.datetime(2011, 4, 16, 6, 24, 31), None),
         ])
 
         it1 = iter(z.generate())
-        next(it1)
+        it2 = iter(z.generate())
+
+        data1 = []
+        data2 = []
+
+        for chunk1, chunk2 in zip(it1, it2):
+            data1.append(chunk1)
+            data2.append(chunk2)
+
+        self.assertEqual(b''.join(data1), b''.join(data2))
+        self.assertEqual(len(zipfile.ZipFile(BytesIO(b''.join(data1))).infolist()), 2)
+
+    def test_generate_threads(self):
+        z = ZipStream(files=[
+            ZipFile('file-%d.txt' % i, 4, lambda: BytesIO(b'test'), datetime.datetime(2008, 11, 10, 17, 53, 59), None)
+            for i in range(50)
+        ])
+
+        expected = b''.join(z.generate())
+        results = []
+
+        def download():
+            results.append((b''.join(z.generate()), z.size()))
+
+        threads = [threading.Thread(target=download) for _ in range(8)]
+
+        for t in threads:
+            t.start()
+
+        for t in threads:
+            t.join()
+
+        self.assertEqual(results, [(expected, len(expected))] * 8)
+
+    def test_write_to(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        content = b'local file content' * 1000
+        local_path = os.path.join(tmp_dir, 'local.txt')
+
+        with open(local_path, 'wb') as f:
+            f.write(content)
+
+        z = ZipStream(files=[
+            ZipFile('file.txt', 4, lambda: BytesIO(b'test'), datetime.datetime(2008, 11, 10, 17, 53, 59), None),
+            ZipFile('dir/', None, None, datetime.datetime(2011, 4, 16, 6, 24, 31), None),
+            ZipFile('local.txt', len(content), lambda: open(local_path, 'rb'), datetime.datetime(2011, 4, 16, 6, 24, 31), None, zlib.crc32(content) & 0xffffffff),
+            ZipFile('local-nocrc.txt', len(content), lambda: open(local_path, 'rb'), datetime.datetime(2011, 4, 16, 6, 24, 31), None),
+        ], comment=b'zip comment')
+
+        expected = b''.join(z.generate())
+
+        out_path = os.path.join(tmp_dir, 'out.zip')
+
+        with open(out_path, 'wb') as f:
+            size = z.write_to(f)
+
+        with open(out_path, 'rb') as f:
+            data = f.read()
+
+        self.assertEqual(size, len(expected))
+        self.assertEqual(data, expected)
+
+        zf = zipfile.ZipFile(BytesIO(data))
+
+        self.assertEqual(zf.open('local.txt').read(), content)
+        self.assertEqual(zf.open('local-nocrc.txt').read(), content)
+
+    def test_write_to_append(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        content = b'local file content' * 1000
+        local_path = os.path.join(tmp_dir, 'local.txt')
+
+        with open(local_path, 'wb') as f:
+            f.write(content)
+
+        z = ZipStream(files=[
+            ZipFile('local.txt', len(content), lambda: open(local_path, 'rb'), datetime.datetime(2011, 4, 16, 6, 24, 31), None, zlib.crc32(content) & 0xffffffff),
+        ])
+
+        out_path = os.path.join(tmp_dir, 'out.bin')
+
+        with open(out_path, 'wb') as f:
+            f.write(b'prefix')
+
+        with open(out_path, 'ab') as f:
+            z.write_to(f)
+
+        with open(out_path, 'rb') as f:
+            self.assertEqual(f.read(), b'prefix' + b''.join(z.generate()))
+
+    def test_write_to_short_file(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        local_path = os.path.join(tmp_dir, 'local.txt')
+
+        with open(local_path, 'wb') as f:
+            f.write(b'test')
+
+        z = ZipStream(files=[
+            ZipFile('local.txt', 10, lambda: open(local_path, 'rb'), None, None, 0),
+        ])
+
+        with open(os.path.join(tmp_dir, 'out.zip'), 'wb') as f:
+            size = z.write_to(f)
+
+        # falls back to reading the file, which ignores the declared size
+        self.assertEqual(size, len(b''.join(z.generate())))
+
+    def test_deterministic(self):
+        def create_zip_stream():
+            return ZipStream(files=[
+                ZipFile('file.txt', 4, lambda: BytesIO(b'test'), None, None),
+                ZipFile('dir/', None, None, None, None),
+            ], deterministic=True)
+
+        data = b''.join(create_zip_stream().generate())
+
+        self.assertEqual(b''.join(create_zip_stream().generate()), data)
+
+        zf = zipfile.ZipFile(BytesIO(data))
+
+        self.assertEqual(zf.getinfo('file.txt').date_time, (1980, 1, 1, 0, 0, 0))
+
+    def test_etag(self):
+        def create_zip_stream(crc, **kwargs):
+            return ZipStream(files=[
+                ZipFile('file.txt', 4, lambda: BytesIO(b'test'), datetime.datetime(2008, 11, 10, 17, 53, 59), None, crc),
+                ZipFile('dir/', None, None, datetime.datetime(2011, 4, 16, 6, 24, 31), None),
+                ZipFile('remote.txt', 3, lambda: BytesIO(b'BBB'), datetime.datetime(2011, 4, 16, 6, 24, 31), None, None, 'v1'),
+            ], **kwargs)
+
+        etag = create_zip_stream(3632233996).etag()
+
+        self.assertTrue(etag.startswith('"') and etag.endswith('"'))
+        self.assertEqual(create_zip_stream(3632233996).etag(), etag)
+        self.assertNotEqual(create_zip_stream(1).etag(), etag)
+        self.assertNotEqual(create_zip_stream(3632233996, comment=b'x').etag(), etag)
+
+    def test_etag_version_required(self):
+        z = ZipStream(files=[
+            ZipFile('file.txt', 4, lambda: BytesIO(b'test'), datetime.datetime(2008, 11, 10, 17, 53, 59), None),
+        ])
+
+        with self.assertRaises(ZipFileVersionRequired):
+            z.etag()
+
+    def test_etag_datetime_required(self):
+        files = [
+            ZipFile('file.txt', 4, lambda: BytesIO(b'test'), None, None, 3632233996),
+        ]
+
+        with self.assertRaises(ZipFileDatetimeRequired):
+            ZipStream(files=files).etag()
+
+        ZipStream(files=files, deterministic=True).etag()
+
+    def test_scheduler_limits(self):
+        scheduler = SourceScheduler(max_concurrency=3, max_per_host=1)
+        lock = threading.Lock()
+        active = {}
+        max_active = {}
+
+        def create_fp(host):
+            def create():
+                with lock:
+                    active[host] = active.get(host, 0) + 1
+                    max_active[host] = max(max_active.get(host, 0), active[host])
+                    max_active[None] = max(max_active.get(None, 0), sum(active.values()))
+
+                time.sleep(0.01)
+
+                with lock:
+                    active[host] -= 1
+
+                return BytesIO(b'test')
+
+            return create
+
+        def download():
+            z = ZipStream(files=[
+                ZipFile('%s-%d.txt' % (host, i), 4, create_fp(host), None, None, host=host)
+                for i in range(3)
+                for host in ('a', 'b', 'c', 'd')
+            ], scheduler=scheduler)
+
+            zf = zipfile.ZipFile(BytesIO(b''.join(z.generate())))
+
+            self.assertEqual(len(zf.infolist()), 12)
+
+        threads = [threading.Thread(target=download) for _ in range(8)]
+
+        for t in threads:
+            t.start()
+
+        for t in threads:
+            t.join()
+
+        self.assertEqual(max_active['a'], 1)
+        self.assertEqual(max_active['b'], 1)
+        self.assertLessEqual(max_active[None], 3)
+
+    def test_scheduler_open_files(self):
+        scheduler = SourceScheduler(max_per_host=2)
+        lock = threading.Lock()
+        open_files = [0]
+        max_open_files = [0]
+
+        class SlowFile(BytesIO):
+            def __init__(self, data):
+                BytesIO.__init__(self, data)
+
+                with lock:
+                    open_files[0] += 1
+                    max_open_files[0] = max(max_open_files[0], open_files[0])
+
+            def read(self, size=-1):
+                time.sleep(0.001)
+                return BytesIO.read(self, size)
+
+            def close(self):
+                with lock:
+                    open_files[0] -= 1
+
+                BytesIO.close(self)
+
+        def download():
+            z = ZipStream(files=[
+                ZipFile('file-%d.txt' % i, 10000, lambda: SlowFile(b'a' * 10000), None, None, host='a')
+                for i in range(3)
+            ], scheduler=scheduler)
+
+            b''.join(z.generate())
+
+        threads = [threading.Thread(target=download) for _ in range(6)]
+
+        for t in threads:
+            t.start()
+
+        for t in threads:
+            t.join()
+
+        self.assertEqual(max_open_files[0], 2)
+        self.assertEqual(open_files[0], 0)
+
+    def test_scheduler_abandoned(self):
+        scheduler = SourceScheduler(max_concurrency=1)
+
+        z = ZipStream(files=[
+            ZipFile('file.txt', 4, lambda: BytesIO(b'test'), None, None),
+        ], scheduler=scheduler)
+
+        it = z.generate()
+        next(it)
+        next(it)
+        next(it)
+
+        self.assertEqual(scheduler.active(), 1)
+
+        it.close()
+
+        self.assertEqual(scheduler.active(), 0)
+
+    def test_scheduler_round_robin(self):
+        scheduler = SourceScheduler(max_concurrency=1)
+        order = []
+
+        def run(stream, name):
+            with scheduler.slot(stream):
+                order.append(name)
+
+        scheduler.acquire('main')
+
+        threads = []
+
+        for stream, name in (('a', 'a1'), ('a', 'a2'), ('b', 'b1')):
+            t = threading.Thread(target=run, args=(stream, name))
+            t.start()
+            threads.append(t)
+
+            wait_until(lambda: scheduler.waiting() == len(threads))
+
+        scheduler.release()
+
+        for t in threads:
+            t.join()
+
+        self.assertEqual(order, ['a1', 'b1', 'a2'])
+
+    def test_scheduler_pool(self):
+        pools = []
+
+        class Pool(object):
+            def __init__(self, host):
+                self.host = host
+                self.closed = False
+                pools.append(self)
+
+            def close(self):
+                self.closed = True
+
+        scheduler = SourceScheduler(pool_factory=Pool)
+
+        self.assertIs(scheduler.pool('a'), scheduler.pool('a'))
+        self.assertEqual(scheduler.pool('b').host, 'b')
+
+        scheduler.close()
+
+        self.assertEqual([pool.closed for pool in pools], [True, True])
+
+    def test_archive_entries(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        archive_path = os.path.join(tmp_dir, 'source.zip')
+        content = b'deflated content ' * 1000
+
+        with zipfile.ZipFile(archive_path, 'w') as src:
+            src.writestr(zipfile.ZipInfo('deflated.txt', (2011, 4, 16, 6, 24, 30)), content, zipfile.ZIP_DEFLATED)
+            src.writestr(zipfile.ZipInfo('stored.txt', (2011, 4, 16, 6, 24, 30)), b'stored', zipfile.ZIP_STORED)
+            src.writestr(zipfile.ZipInfo('other.txt', (2011, 4, 16, 6, 24, 30)), b'other', zipfile.ZIP_STORED)
+
+        entries = archive_entries(lambda: open(archive_path, 'rb'), ['deflated.txt', 'stored.txt'])
+
+        z = ZipStream(files=[
+            ZipFile('file.txt', 4, lambda: BytesIO(b'test'), datetime.datetime(2008, 11, 10, 17, 53, 59), None),
+            entries[0]._replace(filename='dir/renamed.txt'),
+            entries[1],
+        ])
+
+        data = b''.join(z.generate())
+
+        zf = zipfile.ZipFile(BytesIO(data))
+
+        self.assertIsNone(zf.testzip())
+        self.assertEqual([info.filename for info in zf.infolist()], ['file.txt', 'dir/renamed.txt', 'stored.txt'])
+        self.assertEqual(zf.getinfo('dir/renamed.txt').compress_type, zipfile.ZIP_DEFLATED)
+        self.assertLess(zf.getinfo('dir/renamed.txt').compress_size, len(content))
+        self.assertEqual(zf.getinfo('dir/renamed.txt').date_time, (2011, 4, 16, 6, 24, 30))
+        self.assertEqual(zf.open('dir/renamed.txt').read(), content)
+        self.assertEqual(zf.open('stored.txt').read(), b'stored')
+
+        self.assertEqual(z.size(), len(data))
+
+        out_path = os.path.join(tmp_dir, 'out.zip')
+
+        with open(out_path, 'wb') as f:
+            z.write_to(f)
+
+        with open(out_path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_cache(self):
+        cache = SourceCache(max_size=1024, max_file_size=100, ignore_skip=True)
+        counter = FileCounter()
+
+        def create_zip_stream():
+            return ZipStream(files=[
+                ZipFile('license.txt', 7, counter.create_fp(b'license'), datetime.datetime(2008, 11, 10, 17, 53, 59), None, source_id='license', version=1),
+                ZipFile('big.bin', 200, counter.create_fp(b'b' * 200), datetime.datetime(2008, 11, 10, 17, 53, 59), None, source_id='big', version=1),
+                ZipFile('file.txt', 4, counter.create_fp(b'test'), datetime.datetime(2008, 11, 10, 17, 53, 59), None),
+            ], cache=cache)
+
+        data1 = b''.join(create_zip_stream().generate())
+        data2 = b''.join(create_zip_stream().generate())
+
+        self.assertEqual(data1, data2)
+        self.assertEqual(counter.calls, [b'license', b'b' * 200, b'test', b'b' * 200, b'test'])
+        self.assertEqual(counter.open_files(), 0)
+        self.assertEqual(len(cache), 1)
+
+        zf = zipfile.ZipFile(BytesIO(data2))
+
+        self.assertIsNone(zf.testzip())
+        self.assertEqual(zf.open('license.txt').read(), b'license')
+
+    def test_cache_skip(self):
+        skipped = []
+
+        def create_fp():
+            if skipped:
+                raise ZipFileSkip()
+
+            return BytesIO(b'license')
+
+        def create_zip_stream(cache):
+            return ZipStream(files=[
+                ZipFile('license.txt', 7, create_fp, None, None, source_id='license', version=1),
+                ZipFile('file.txt', 4, lambda: BytesIO(b'test'), None, None),
+            ], cache=cache)
+
+        def filenames(z):
+            return [info.filename for info in zipfile.ZipFile(BytesIO(b''.join(z.generate()))).infolist()]
+
+        def check_skip(zip_file):
+            if skipped:
+                raise ZipFileSkip()
+
+        for cache in (SourceCache(1024), SourceCache(1024, check_skip=check_skip)):
+            del skipped[:]
+
+            self.assertEqual(filenames(create_zip_stream(cache)), ['license.txt', 'file.txt'])
+            self.assertEqual(len(cache), 1)
+
+            skipped.append(True)
+
+            self.assertEqual(filenames(create_zip_stream(cache)), ['file.txt'])
+
+        cache = SourceCache(1024, ignore_skip=True)
+        del skipped[:]
+
+        filenames(create_zip_stream(cache))
+        skipped.append(True)
+
+        self.assertEqual(filenames(create_zip_stream(cache)), ['license.txt', 'file.txt'])
+
+    def test_cache_max_file_size(self):
+        cache = SourceCache(max_size=1024 * 1024, ignore_skip=True)
+        data = b'a' * (64 * 1024)
+
+        def create_zip_stream():
+            return ZipStream(files=[
+                ZipFile('small.bin', len(data), lambda: BytesIO(data), None, None, source_id='small', version=1),
+                ZipFile('big.bin', len(data) + 1, lambda: BytesIO(data + b'a'), None, None, source_id='big', version=1),
+            ], cache=cache)
+
+        b''.join(create_zip_stream().generate())
+
+        self.assertEqual(cache.max_file_size, len(data))
+        self.assertEqual(len(cache), 1)
+
+        chunks = list(create_zip_stream().generate())
+
+        self.assertLessEqual(max(len(chunk) for chunk in chunks), len(data) // 2)
+        self.assertIsNone(zipfile.ZipFile(BytesIO(b''.join(chunks))).testzip())
+        self.assertEqual(SourceCache(max_size=10).max_file_size, 10)
+
+    def test_cache_version_required(self):
+        cache = SourceCache(1024)
+
+        z = ZipStream(files=[
+            ZipFile('license.txt', 7, lambda: BytesIO(b'license'), None, None, source_id='license'),
+        ], cache=cache)
+
+        b''.join(z.generate())
+
+        self.assertEqual(len(cache), 0)
+
+    def test_cache_eviction(self):
+        cache = SourceCache(max_size=10)
+
+        cache.put(('a', 1), b'aaaa', 1)
+        cache.put(('b', 1), b'bbbb', 2)
+        cache.get(('a', 1))
+        cache.put(('c', 1), b'cccc', 3)
+
+        self.assertIsNotNone(cache.get(('a', 1)))
+        self.assertIsNone(cache.get(('b', 1)))
+        self.assertEqual(cache.get(('c', 1)).crc, 3)
+        self.assertEqual(cache.size(), 8)
+
+        cache.put(('d', 1), b'd' * 11, 4)
+
+        self.assertIsNone(cache.get(('d', 1)))
+        self.assertEqual(len(cache), 2)
+
+    def test_rate_limiter(self):
+        now = [0.0]
+        sleeps = []
+
+        def sleep(delay):
+            sleeps.append(delay)
+            now[0] += delay
+
+        limiter = RateLimiter(1000, burst=2000, clock=lambda: now[0], sleep=sleep)
+
+        limiter.throttle(1500)
+        limiter.throttle(500)
+
+        self.assertEqual(sleeps, [])
+
+        limiter.throttle(500)
+
+        self.assertEqual(sleeps, [0.5])
+
+        now[0] += 10
+        limiter.throttle(2000)
+
+        self.assertEqual(sleeps, [0.5])
+
+    def test_rate_limiter_invalid_rate(self):
+        with self.assertRaises(ValueError):
+            RateLimiter(0)
+
+        with self.assertRaises(ValueError):
+            ZipStream(files=[], rate_limit=0)
+
+        with self.assertRaises(ValueError):
+            RateLimiter(1000, burst=0)
+
+        with self.assertRaises(ValueError):
+            ZipStream(files=[], rate_limit=1000, rate_burst=-1)
+
+        with self.assertRaises(ValueError):
+            ZipStream(files=[], rate_burst=1000)
+
+    def test_rate_limit_shared(self):
+        now = [0.0]
+        sleeps = []
+
+        def sleep(delay):
+            sleeps.append(delay)
+            now[0] += delay
+
+        limiter = RateLimiter(1000, clock=lambda: now[0], sleep=sleep)
+
+        def create_zip_stream():
+            return ZipStream(files=[
+                ZipFile('file.txt', 4000, lambda: BytesIO(b'a' * 4000), datetime.datetime(2008, 11, 10, 17, 53, 59), None),
+            ], rate_limiter=limiter)
+
+        size = 0
+
+        for chunk1, chunk2 in zip(create_zip_stream().generate(), create_zip_stream().generate()):
+            size += len(chunk1) + len(chunk2)
+
+        self.assertAlmostEqual(now[0], (size - 1000) / 1000.0, places=6)
+
+    def test_rate_limit(self):
+        z = ZipStream(files=[
+            ZipFile('file.txt', 4000, lambda: BytesIO(b'a' * 4000), None, None),
+        ], rate_limit=20000, rate_burst=1000)
+
+        start = time.time()
+        data = b''.join(z.generate())
+
+        self.assertEqual(len(data), z.size())
+        self.assertGreaterEqual(time.time() - start, 0.1)
+
+    def test_ready_first(self):
+        def slow():
+            time.sleep(0.2)
+            return BytesIO(b'slow')
+
+        z = ZipStream(files=[
+            ZipFile('slow.txt', 4, slow, datetime.datetime(2008, 11, 10, 17, 53, 59), None),
+            ZipFile('fast.txt', 4, lambda: BytesIO(b'fast'), datetime.datetime(2008, 11, 10, 17, 53, 59), None),
+            ZipFile('skip.txt', 4, skip, datetime.datetime(2008, 11, 10, 17, 53, 59), None),
+            ZipFile('dir/', None, None, datetime.datetime(2011, 4, 16, 6, 24, 31), None),
+        ], ready_first=True, prefetch=4)
+
+        data = b''.join(z.generate())
+
+        zf = zipfile.ZipFile(BytesIO(data))
+
+        self.assertIsNone(zf.testzip())
+        self.assertEqual([info.filename for info in zf.infolist()][-1], 'slow.txt')
+        self.assertEqual(sorted(info.filename for info in zf.infolist()), ['dir/', 'fast.txt', 'slow.txt'])
+        self.assertEqual(zf.open('slow.txt').read(), b'slow')
+        self.assertEqual(zf.open('fast.txt').read(), b'fast')
+
+    def test_ready_first_close(self):
+        counter = FileCounter()
+
+        z = ZipStream(files=[
+            ZipFile('file-%d.txt' % i, 4, counter.create_fp(b'test'), None, None)
+            for i in range(10)
+        ], ready_first=True, prefetch=3)
+
+        it = z.generate()
+        next(it)
+        it.close()
+
+        # the file being written and up to prefetch files opened ahead, all
+        # closed by the time close() returns
+        self.assertGreaterEqual(counter.opened, 1)
+        self.assertLessEqual(counter.opened, 4)
+        self.assertEqual(counter.open_files(), 0)
+
+    def test_ready_first_invalid_prefetch(self):
+        with self.assertRaises(ValueError):
+            ZipStream(files=[], ready_first=True, prefetch=0)
+
+        with self.assertRaises(ValueError):
+            imap_unordered(lambda x: x, [1], 0, lambda result: None)
+
+    def test_ready_first_base_exception(self):
+        class Interrupt(BaseException):
+            pass
+
+        def interrupt():
+            raise Interrupt()
+
+        z = ZipStream(files=[
+            ZipFile('file.txt', 4, lambda: BytesIO(b'test'), None, None),
+            ZipFile('interrupt.txt', 4, interrupt, None, None),
+        ], ready_first=True)
+
+        with self.assertRaises(Interrupt):
+            b''.join(z.generate())
+
+    def test_ready_first_threads(self):
+        threads = set()
+
+        def create_fp():
+            threads.add(threading.current_thread())
+            return BytesIO(b'test')
+
+        z = ZipStream(files=[
+            ZipFile('file-%d.txt' % i, 4, create_fp, None, None)
+            for i in range(50)
+        ], ready_first=True, prefetch=4)
+
+        zf = zipfile.ZipFile(BytesIO(b''.join(z.generate())))
+
+        self.assertEqual(len(zf.infolist()), 50)
+        self.assertLessEqual(len(threads), 4)
+
+    def test_ready_first_error(self):
+        def fail():
+            raise IOError('not found')
+
+        z = ZipStream(files=[
+            ZipFile('file.txt', 4, lambda: BytesIO(b'test'), None, None),
+            ZipFile('missing.txt', 4, fail, None, None),
+        ], ready_first=True)
+
+        with self.assertRaises(IOError):
+            b''.join(z.generate())
+
+    def test_group_by_host(self):
+        z = ZipStream(files=[
+            ZipFile('a1.txt', 4, lambda: BytesIO(b'test'), None, None, host='a'),
+            ZipFile('b1.txt', 4, lambda: BytesIO(b'test'), None, None, host='b'),
+            ZipFile('a2.txt', 4, lambda: BytesIO(b'test'), None, None, host='a'),
+            ZipFile('dir/', None, None, None, None),
+        ], group_by_host=True)
+
+        data = b''.join(z.generate())
+
+        zf = zipfile.ZipFile(BytesIO(data))
+
+        self.assertEqual([info.filename for info in zf.infolist()], ['a1.txt', 'a2.txt', 'b1.txt', 'dir/'])
+        self.assertEqual(z.size(), len(data))
+
+    def test_preflight(self):
+        counter = FileCounter()
+
+        z = ZipStream(files=[
+            ZipFile('file.txt', 4, counter.create_fp(b'test'), datetime.datetime(2008, 11, 10, 17, 53, 59), None),
+            ZipFile('dir/', None, None, datetime.datetime(2011, 4, 16, 6, 24, 31), None),
+            ZipFile('skip.txt', 3, skip, datetime.datetime(2011, 4, 16, 6, 24, 31), None),
+            ZipFile('other.txt', 3, counter.create_fp(b'BBB'), datetime.datetime(2011, 4, 16, 6, 24, 31), None),
+        ])
+
+        prepared = z.preflight(workers=2, keep=10)
+
+        self.assertEqual(sorted(counter.calls), [b'BBB', b'test'])
+
+        size = prepared.size()
+        data = b''.join(prepared.generate())
+
+        self.assertEqual(size, len(data))
+        self.assertEqual(sorted(counter.calls), [b'BBB', b'test'])
+
+        zf = zipfile.ZipFile(BytesIO(data))
+
+        self.assertIsNone(zf.testzip())
+        self.assertEqual([info.filename for info in zf.infolist()], ['file.txt', 'dir/', 'other.txt'])
+
+        # files are opened again for later generations
+        self.assertEqual(b''.join(prepared.generate()), data)
+        self.assertEqual(len(counter.calls), 4)
+        self.assertEqual(counter.open_files(), 0)
+        self.assertEqual(len(z.files), 4)
+
+    def test_preflight_probe(self):
+        counter = FileCounter()
+
+        z = ZipStream(files=[
+            ZipFile('file.txt', 4, counter.create_fp(b'test'), None, None),
+            ZipFile('skip.txt', 3, skip, None, None),
+            ZipFile('other.txt', 3, counter.create_fp(b'BBB'), None, None),
+        ])
+
+        prepared = z.preflight()
+
+        self.assertTrue(prepared.preflighted)
+        self.assertFalse(z.preflighted)
+        self.assertEqual(counter.closed, 2)
+
+        data = b''.join(prepared.generate())
+
+        self.assertEqual(prepared.size(), len(data))
+        self.assertEqual(sorted(counter.calls), [b'BBB', b'BBB', b'test', b'test'])
+
+    def test_preflight_invalid(self):
+        z = ZipStream(files=[])
+
+        with self.assertRaises(ValueError):
+            z.preflight(workers=0)
+
+        with self.assertRaises(ValueError):
+            z.preflight(keep=-1)
+
+    def test_preflight_open_files(self):
+        counter = FileCounter()
+
+        z = ZipStream(files=[
+            ZipFile('file-%d.txt' % i, 4, counter.create_fp(b'test'), None, None)
+            for i in range(200)
+        ])
+
+        prepared = z.preflight(workers=4, keep=16)
+
+        # kept files and one file per worker
+        self.assertLessEqual(counter.max_open, 16 + 4)
+        self.assertEqual(counter.open_files(), 16)
+
+        zf = zipfile.ZipFile(BytesIO(b''.join(prepared.generate())))
+
+        self.assertEqual(len(zf.infolist()), 200)
+        self.assertLessEqual(counter.max_open, 16 + 4)
+        self.assertEqual(counter.open_files(), 0)
+
+    def test_preflight_scheduler_keep(self):
+        scheduler = SourceScheduler(max_per_host=2)
+        counter = FileCounter()
+
+        z = ZipStream(files=[
+            ZipFile('file-%d.txt' % i, 4, counter.create_fp(b'test'), None, None, host='a')
+            for i in range(10)
+        ], scheduler=scheduler)
+
+        prepared = z.preflight(keep=10)
+
+        # kept files don't hold slots
+        self.assertEqual(scheduler.active(), 0)
+        self.assertEqual(counter.open_files(), 10)
+
+        b''.join(prepared.generate())
+
+        self.assertEqual(scheduler.active(), 0)
+        self.assertEqual(counter.opened, 10)
+        self.assertEqual(counter.open_files(), 0)
+
+    def test_preflight_scheduler_concurrent(self):
+        scheduler = SourceScheduler(max_concurrency=3)
+        counter = FileCounter()
+        prepared = []
+
+        def preflight():
+            z = ZipStream(files=[
+                ZipFile('file-%d.txt' % i, 4, counter.create_fp(b'test'), None, None)
+                for i in range(20)
+            ], scheduler=scheduler)
+
+            prepared.append(z.preflight(workers=4, keep=10))
+
+        threads = [threading.Thread(target=preflight) for _ in range(2)]
+
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        for thread in threads:
+            thread.join(5)
+
+            self.assertFalse(thread.is_alive())
+
+        self.assertEqual(len(prepared), 2)
+
+        for z in prepared:
+            zf = zipfile.ZipFile(BytesIO(b''.join(z.generate())))
+
+            self.assertEqual(len(zf.infolist()), 20)
+
+        self.assertEqual(scheduler.active(), 0)
+        self.assertEqual(counter.open_files(), 0)
+
+    def test_preflight_size_mismatch(self):
+        counter = FileCounter()
+
+        z = ZipStream(files=[
+            ZipFile('file.txt', 4, counter.create_fp(b'test'), None, None),
+            ZipFile('short.txt', 10, counter.create_fp(b'short'), None, None),
+        ])
+
+        with self.assertRaises(ZipFileSizeMismatch):
+            z.preflight()
+
+        self.assertEqual(counter.open_files(), 0)
+
+    def test_preflight_error(self):
+        def fail():
+            raise IOError('not found')
+
+        z = ZipStream(files=[
+            ZipFile('file-%d.txt' % i, 4, lambda: BytesIO(b'test'), None, None)
+            for i in range(10)
+        ] + [
+            ZipFile('missing.txt', 4, fail, None, None),
+        ])
+
+        with self.assertRaises(IOError):
+            z.preflight(workers=4)
+
+    def test_preflight_close(self):
+        counter = FileCounter()
+
+        z = ZipStream(files=[
+            ZipFile('file-%d.txt' % i, 4, counter.create_fp(b'test'), None, None)
+            for i in range(3)
+        ])
+
+        prepared = z.preflight(keep=3)
+        prepared.close()
 
-        with self.assertRaises(ZipFileInProgress):
-            it2 = iter(z.generate())
-            next(it2)
+        self.assertEqual(counter.closed, 3)
 
 
 # Reference implementation in Go
@@ -14,183 +14,542 @@ from __future__ import unicode_literals
 
 from binascii import crc32
 import datetime
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+import copy
+import hashlib
+import os
+import stat
 import struct
+import threading
 import time
 import calendar
 
-from .compat import str  # pylint: disable=redefined-builtin
+from .compat import str, Queue  # pylint: disable=redefined-builtin
+from .exceptions import (
+    ZipStreamError, FileNameTooLong, ZipFileSizeRequired, ZipFileInProgress,
+    ZipFileBytesRequired, ZipFileVersionRequired, ZipFileDatetimeRequired,
+    ZipFileEncrypted, ZipFileSizeMismatch, ZipFileSkip,
+)
+from .structs import (
+    ZipFile, RawZipEntry, ZIP_MODE_STORED, FLAG_COMPRESSION_OPTIONS,
+    STRUCT_FILE_HEADER, STRING_FILE_HEADER, STRUCT_DATA_DESCRIPTOR,
+    STRUCT_DATA_DESCRIPTOR64, STRING_DATA_DESCRIPTOR, STRUCT_CENTRAL_DIR,
+    STRING_CENTRAL_DIR, STRUCT_ZIP64_EXTRA, ZIP64_EXTRA_ID, ZIP64_EXTRA_SIZE,
+    STRUCT_EXT_TIME_EXTRA, EXT_TIME_EXTRA_ID, EXT_TIME_EXTRA_SIZE,
+    EXT_TIME_EXTRA_FLAGS, STRUCT_END_ARCHIVE, STRING_END_ARCHIVE,
+    STRUCT_END_ARCHIVE64_LOCATOR, STRING_END_ARCHIVE64_LOCATOR,
+    STRUCT_END_ARCHIVE64, STRING_END_ARCHIVE64, UINT16_MAX, UINT32_MAX,
+    ZIP_VERSION_20, ZIP_VERSION_45,
+)
+from .scheduler import SourceScheduler, ScheduledFile
+from .cache import SourceCache
+from .ratelimit import RateLimiter
+from .fdio import FdWriter, FileRange, get_file_range
+from .archive import archive_entries
 
 __all__ = [
     'ZipStream',
     'ZipFile',
+    'SourceScheduler',
+    'SourceCache',
+    'RateLimiter',
+    'RawZipEntry',
+    'archive_entries',
     'ZipStreamError',
     'FileNameTooLong',
     'ZipFileSizeRequired',
     'ZipFileInProgress',
+    'ZipFileVersionRequired',
+    'ZipFileDatetimeRequired',
+    'ZipFileEncrypted',
+    'ZipFileSizeMismatch',
 ]
 
-ZIP_MODE_STORED = 0
+READ_CHUNK_SIZE = 4096
 
-STRUCT_FILE_HEADER = '<4s2B4HL2L2H'
-STRING_FILE_HEADER = b'PK\x03\x04'
+# used for files without datetime in deterministic mode (DOS epoch)
+DETERMINISTIC_DATETIME = (1980, 1, 1, 0, 0, 0, 1, 1, 0)
 
-STRUCT_DATA_DESCRIPTOR = '<4sLLL'
-STRUCT_DATA_DESCRIPTOR64 = '<4sLQQ'
-# de-facto standard, required by OS X Finder
-STRING_DATA_DESCRIPTOR = b'PK\x07\x08'
+# bump when the generated bytes change for the same manifest
+ETAG_FORMAT = b'zipstreamer-etag-1'
 
-STRUCT_CENTRAL_DIR = '<4s4B4HL2L5H2L'
-STRING_CENTRAL_DIR = b'PK\x01\x02'
-
-STRUCT_ZIP64_EXTRA = '<2H3Q'
-ZIP64_EXTRA_ID = 0x0001  # Zip64 extended information
-ZIP64_EXTRA_SIZE = 24  # 3x uint64
+DirEntry = namedtuple('DirEntry', [
+    'filename', 'extra', 'comment', 'create_version',
+    'extract_version', 'flag_bits', 'dostime', 'dosdate',
+    'file_crc', 'file_size', 'external_attr', 'offset', 'is_zip64',
+    'compress_type', 'compress_size',
+])
 
-STRUCT_EXT_TIME_EXTRA = '<2HBL'
-EXT_TIME_EXTRA_ID = 0x5455  # Extended timestamp
-EXT_TIME_EXTRA_SIZE = 5  # uint8 + uint32
-EXT_TIME_EXTRA_FLAGS = 1  # ModTime
 
-STRUCT_END_ARCHIVE = '<4s4H2LH'
-STRING_END_ARCHIVE = b'PK\x05\x06'
+OpenedFile = namedtuple('OpenedFile', ['file_obj', 'cached'])
 
-STRUCT_END_ARCHIVE64_LOCATOR = '<4sLQL'
-STRING_END_ARCHIVE64_LOCATOR = b'PK\x06\x07'
 
-STRUCT_END_ARCHIVE64 = '<4sQ2H2L4Q'
-STRING_END_ARCHIVE64 = b'PK\x06\x06'
+class PreflightFiles(object):
+    """
+    Files opened by ``ZipStream.preflight()``. Each one is used by the first
+    generation that writes its ZipFile, later generations open it again.
+    """
 
-UINT16_MAX = (1 << 16) - 1
-UINT32_MAX = (1 << 32) - 1
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._files = {}
 
-ZIP_VERSION_20 = 20  # 2.0
-ZIP_VERSION_45 = 45  # 4.5 (reads and writes zip64 archives)
+    def add(self, zip_file, opened):
+        with self._lock:
+            self._files.setdefault(id(zip_file), []).append(opened)
 
+    def pop(self, zip_file):
+        with self._lock:
+            opened_list = self._files.get(id(zip_file))
 
-class ZipStreamError(Exception):
-    pass
+            if not opened_list:
+                return None
 
+            opened = opened_list.pop()
 
-class FileNameTooLong(ZipStreamError):
-    pass
+            if not opened_list:
+                del self._files[id(zip_file)]
 
+            return opened
 
-class ZipFileSizeRequired(ZipStreamError):
-    pass
+    def close(self):
+        with self._lock:
+            files = self._files
+            self._files = {}
 
+        for opened_list in files.values():
+            for opened in opened_list:
+                close_opened_file(opened)
 
-class ZipFileInProgress(ZipStreamError):
-    pass
 
+class GenerateContext(object):
+    """
+    State of a single generate(), size() or write_to() call, so that one
+    ZipStream can be used by any number of them concurrently.
+    """
 
-class ZipFileBytesRequired(ZipStreamError):
-    pass
+    def __init__(self, calculate_size=False, copy_ranges=False,
+                 rate_limiters=()):
+        self.calculate_size = calculate_size
+        self.copy_ranges = copy_ranges
+        self.rate_limiters = rate_limiters
 
+        self.dir = []
+        self.pos = 0
 
-class ZipFileSkip(Exception):
-    """
-    ZipFileSkip can be used to skip the file when ``create_fp`` is called.
-    It should not be used when ``.size()`` is used.
-    """
+    def incr(self, buf):
+        assert not isinstance(buf, str)
 
-    def __init__(self):
-        super(ZipFileSkip, self).__init__('Skip the file')
+        self.pos += len(buf)
 
+        return buf
 
-ZipFile = namedtuple('ZipFile', [
-    'filename', 'size', 'create_fp', 'datetime', 'comment',
-])
+    def throttle(self, size):
+        if not self.rate_limiters or not size:
+            return
 
+        delays = [(limiter.reserve(size), limiter)
+                  for limiter in self.rate_limiters]
+        delay, limiter = max(delays, key=lambda x: x[0])
 
-DirEntry = namedtuple('DirEntry', [
-    'filename', 'extra', 'comment', 'create_version',
-    'extract_version', 'flag_bits', 'dostime', 'dosdate',
-    'file_crc', 'file_size', 'external_attr', 'offset', 'is_zip64',
-])
+        if delay > 0:
+            limiter.sleep(delay)
 
 
-class ZipStream(object):
-    def __init__(self, files, comment=None):
+class ZipStream(object):  # pylint: disable=too-many-instance-attributes
+    def __init__(  # pylint: disable=too-many-arguments
+            self, files, comment=None, deterministic=False, scheduler=None,
+            cache=None, rate_limit=None, rate_burst=None, rate_limiter=None,
+            ready_first=False, group_by_host=False, prefetch=8):
         if isinstance(comment, str):
             raise ZipFileBytesRequired('ZIP comment should bytes')
 
+        if rate_limit is not None and rate_limit <= 0:
+            raise ValueError('Rate limit should be positive: %s' % rate_limit)
+
+        if rate_burst is not None and rate_limit is None:
+            raise ValueError('Rate burst requires a rate limit')
+
+        if rate_burst is not None and rate_burst <= 0:
+            raise ValueError('Rate burst should be positive: %s' % rate_burst)
+
+        if prefetch < 1:
+            raise ValueError('Prefetch should be positive: %s' % prefetch)
+
         self.files = files
         self.comment = comment
-
-        self._dir = None
-        self._pos = None
-        self._generating = False
-        self._calculate_size = False
+        self.deterministic = deterministic
+        self.scheduler = scheduler
+        self.cache = cache
+        self.rate_limit = rate_limit
+        self.rate_burst = rate_burst
+        self.rate_limiter = rate_limiter
+        self.ready_first = ready_first
+        self.group_by_host = group_by_host
+        self.prefetch = prefetch
+
+        self.preflighted = False
+        self.preflight_files = PreflightFiles()
 
     def generate(self):
-        if self._generating:
-            raise ZipFileInProgress('ZipFile generator already in progress')
+        # throttling before the next chunk is requested also pauses reading
+        # from the sources
+        ctx = GenerateContext(rate_limiters=self._create_rate_limiters())
 
-        self._generating = True
+        for chunk in self._generate_zip_file(ctx):
+            yield chunk
 
-        try:
-            for chunk in self._generate_zip_file():
-                yield chunk
-        finally:
-            self._generating = False
+            ctx.throttle(len(chunk))
 
     def size(self):
-        if self._generating:
-            raise ZipFileInProgress(
-                'ZipFile generator already in progress. You need to call'
-                ' size() before generate()')
+        ctx = GenerateContext(calculate_size=True)
+
+        for _ in self._generate_zip_file(ctx):
+            pass
+
+        return ctx.pos
+
+    def write_to(self, fd):
+        """
+        Write the ZIP file to ``fd`` (a file descriptor or an object with
+        ``fileno()``) and return the number of bytes written.
 
-        self._calculate_size = True
+        Small chunks are batched with ``os.writev``. Contents of regular files
+        with known ``size`` and ``crc`` are copied in the kernel with
+        ``os.copy_file_range`` where available.
+        """
+        if hasattr(fd, 'fileno'):
+            if hasattr(fd, 'flush'):
+                fd.flush()
+
+            fd = fd.fileno()
+
+        ctx = GenerateContext(copy_ranges=True)
+        writer = FdWriter(fd)
+
+        for chunk in self._generate_zip_file(ctx):
+            if isinstance(chunk, FileRange):
+                writer.copy(chunk)
+            else:
+                writer.write(chunk)
+
+        writer.flush()
+
+        return ctx.pos
+
+    def preflight(self, workers=8, keep=0):
+        """
+        Open all files on up to ``workers`` threads before generating and
+        return a copy of the ZipStream without the files raising ZipFileSkip,
+        so ``size()`` and ``etag()`` of the copy are exact. Sizes of seekable
+        sources are checked against ``ZipFile.size``. On the first error all
+        opened files are closed and the error is raised.
+
+        Files are closed after they are checked and opened again while
+        generating, except for the first ``keep`` files, which the copy
+        writes from the already opened files. Kept files release their
+        scheduler slots, so they do not count against the scheduler limits.
+        Use ``close()`` on the copy if it is not generated.
+        """
+        if workers < 1:
+            raise ValueError('Workers should be positive: %s' % workers)
+
+        if keep < 0:
+            raise ValueError('Keep should not be negative: %s' % keep)
+
+        ctx = GenerateContext()
+        files = list(self.files)
+        items = [(index, zip_file) for index, zip_file in enumerate(files)
+                 if zip_file.create_fp is not None]
+        keep_indexes = set(index for index, _ in items[:keep])
+        kept_files = {}
+        skipped_indexes = set()
+
+        def open_file(item):
+            index, zip_file = item
+            opened = self._open_file(ctx, zip_file)
+
+            try:
+                check_opened_size(zip_file, opened)
+            except Exception:
+                close_opened_file(opened)
+                raise
+
+            if index not in keep_indexes:
+                close_opened_file(opened)
+                opened = None
+            elif isinstance(opened.file_obj, ScheduledFile):
+                # don't hold slots between preflight and generate, preflights
+                # sharing a scheduler would wait for each other's slots
+                opened.file_obj.release()
+
+            return opened
+
+        def discard(result):
+            close_opened_file(result[1])
+
+        results = imap_unordered(open_file, items, workers, discard)
 
         try:
-            for _ in self.generate():
-                pass
+            for (index, _), opened, error in results:
+                if isinstance(error, ZipFileSkip):
+                    skipped_indexes.add(index)
+                    continue
+
+                if error is not None:
+                    raise error
+
+                if opened is not None:
+                    kept_files[index] = opened
+        except Exception:
+            for opened in kept_files.values():
+                close_opened_file(opened)
+
+            raise
         finally:
-            self._calculate_size = False
+            results.close()
 
-        return self._pos
+        prepared = copy.copy(self)
+        prepared.files = []
+        prepared.preflighted = True
+        prepared.preflight_files = PreflightFiles()
 
-    def _incr(self, buf):
-        assert not isinstance(buf, str)
+        for index, zip_file in enumerate(files):
+            if index in skipped_indexes:
+                continue
 
-        self._pos += len(buf)
+            prepared.files.append(zip_file)
 
-        return buf
+            if index in kept_files:
+                prepared.preflight_files.add(zip_file, kept_files[index])
+
+        return prepared
+
+    def close(self):
+        """
+        Close files kept by ``preflight()`` that were not generated yet.
+        """
+        self.preflight_files.close()
+
+    def etag(self):
+        """
+        Return a strong HTTP ETag computed from the files without generating
+        the ZIP file. Every file with ``create_fp`` needs ``crc`` or
+        ``version`` and, unless the stream is deterministic, ``datetime``.
+
+        The ETag is only valid if no file raises ZipFileSkip (e.g. for streams
+        returned by ``preflight()``), otherwise archives with and without a
+        skipped file get the same ETag.
+        """
+        if self.ready_first:
+            raise ZipStreamError(
+                'ETag is not available when files are written in the order'
+                ' they are ready')
+
+        digest = hashlib.sha1(ETAG_FORMAT)
+
+        def update(value):
+            if value is None:
+                value = b''
+            elif isinstance(value, str):
+                value = value.encode('utf-8')
+            elif not isinstance(value, bytes):
+                value = str(value).encode('utf-8')
+
+            digest.update(struct.pack('<Q', len(value)))
+            digest.update(value)
+
+        files = self.files
+
+        if self.group_by_host:
+            files = order_by_host(files)
+
+        for zip_file in files:
+            filename, flag_bits = encode_filename_flags(zip_file.filename, 8)
+
+            if zip_file.create_fp is not None and zip_file.crc is None and \
+                    zip_file.version is None:
+                raise ZipFileVersionRequired(
+                    'ZipFile.crc or ZipFile.version is required to calculate'
+                    ' ETag: %s' % filename)
+
+            if zip_file.datetime is None and not self.deterministic:
+                raise ZipFileDatetimeRequired(
+                    'ZipFile.datetime is required to calculate ETag of'
+                    ' non-deterministic ZipStream: %s' % filename)
+
+            comment = zip_file.comment
+
+            if isinstance(comment, str):
+                raise ZipFileBytesRequired('File comment should bytes')
+
+            file_dt = get_file_timetuple(zip_file, self.deterministic)
+
+            update(filename)
+            update(flag_bits)
+            update(zip_file.create_fp is not None)
+            update(zip_file.size)
+            update(','.join(str(x) for x in file_dt[:6]))
+            update(comment)
+            update(zip_file.crc)
+            update(zip_file.version)
+            update(zip_file.raw)
+
+        update(self.comment)
+
+        return '"%s"' % digest.hexdigest()
+
+    def _create_rate_limiters(self):
+        rate_limiters = []
+
+        if self.rate_limit is not None:
+            rate_limiters.append(RateLimiter(self.rate_limit, self.rate_burst))
+
+        if self.rate_limiter is not None:
+            rate_limiters.append(self.rate_limiter)
+
+        return rate_limiters
+
+    def _get_cache_key(self, zip_file):
+        if self.cache is None or zip_file.source_id is None or \
+                zip_file.version is None:
+            return None
+
+        return (zip_file.source_id, zip_file.version)
+
+    def _create_fp(self, ctx, zip_file):
+        if self.scheduler is None:
+            return zip_file.create_fp()
+
+        # the slot is released when the file is closed, which happens also
+        # when the generation is abandoned
+        self.scheduler.acquire(ctx, zip_file.host)
+
+        try:
+            file_obj = zip_file.create_fp()
+        except BaseException:
+            self.scheduler.release(zip_file.host)
+            raise
+
+        if file_obj is None:
+            self.scheduler.release(zip_file.host)
+
+            return None
+
+        return ScheduledFile(file_obj, self.scheduler, zip_file.host)
+
+    def _open_file(self, ctx, zip_file):
+        if zip_file.create_fp is None:
+            return OpenedFile(file_obj=None, cached=None)
+
+        if ctx.calculate_size:
+            if zip_file.size is None:
+                raise ZipFileSizeRequired(
+                    'ZipFile.size is required to calculate zip file'
+                    ' size: %s' % zip_file.filename)
+
+            return OpenedFile(file_obj=None, cached=None)
+
+        opened = self.preflight_files.pop(zip_file)
+
+        if opened is not None:
+            return opened
+
+        cache_key = self._get_cache_key(zip_file)
+
+        if cache_key is not None:
+            cached = self.cache.get(cache_key)
+
+            if cached is not None:
+                self._check_cached_skip(ctx, zip_file)
+
+                return OpenedFile(file_obj=None, cached=cached)
+
+        return OpenedFile(file_obj=self._create_fp(ctx, zip_file), cached=None)
+
+    def _check_cached_skip(self, ctx, zip_file):
+        # raises ZipFileSkip if the cached file should be skipped
+        if self.cache.ignore_skip:
+            return
+
+        if self.cache.check_skip is not None:
+            self.cache.check_skip(zip_file)
+            return
 
-    def _generate_file(self, zip_file):
+        close_opened_file(OpenedFile(
+            file_obj=self._create_fp(ctx, zip_file), cached=None))
+
+    def _iter_opened_files(self, ctx):
+        # yields (zip_file, opened) where opened is None if the file still
+        # has to be opened. Archive order does not affect the size.
+        if ctx.calculate_size:
+            return ((zip_file, None) for zip_file in self.files)
+
+        files = self.files
+
+        if self.group_by_host:
+            files = order_by_host(files)
+
+        if self.ready_first:
+            return self._iter_ready_files(ctx, files)
+
+        return ((zip_file, None) for zip_file in files)
+
+    def _iter_ready_files(self, ctx, files):
+        def open_file(zip_file):
+            return self._open_file(ctx, zip_file)
+
+        def discard(result):
+            close_opened_file(result[1])
+
+        results = imap_unordered(open_file, files, self.prefetch, discard)
+
+        try:
+            for zip_file, opened, error in results:
+                if isinstance(error, ZipFileSkip):
+                    continue
+
+                if error is not None:
+                    raise error
+
+                yield zip_file, opened
+        finally:
+            # stop opening files and close the prefetched ones right away
+            results.close()
+
+    def _generate_file(self, ctx, zip_file, opened=None):
         filename, flag_bits = encode_filename_flags(zip_file.filename, 8)
 
         if len(filename) > UINT16_MAX:
+            close_opened_file(opened)
+
             raise FileNameTooLong('File name is too long: %d' % len(filename))
 
-        file_obj = None
+        cache_key = self._get_cache_key(zip_file)
 
-        if zip_file.create_fp is not None:
-            if self._calculate_size:
-                if zip_file.size is None:
-                    raise ZipFileSizeRequired(
-                        'ZipFile.size is required to calculate zip file'
-                        ' size: %s' % filename)
-            else:
-                try:
-                    file_obj = zip_file.create_fp()
-                except ZipFileSkip:
-                    return
+        if opened is None:
+            try:
+                opened = self._open_file(ctx, zip_file)
+            except ZipFileSkip:
+                return
 
-        try:
-            offset = self._pos
+        file_obj, cached = opened
 
-            file_dt = zip_file.datetime
+        try:
+            offset = ctx.pos
 
-            if isinstance(file_dt, datetime.datetime):
-                file_dt = file_dt.timetuple()
+            file_dt = get_file_timetuple(zip_file, self.deterministic)
 
-            if file_dt is None:
-                file_dt = time.localtime(time.time())
+            raw = zip_file.raw
 
             create_version = ZIP_VERSION_20
             extract_version = ZIP_VERSION_20
+            compress_type = ZIP_MODE_STORED
+
+            if raw is not None:
+                compress_type = raw.compress_type
+                flag_bits |= raw.flag_bits & FLAG_COMPRESSION_OPTIONS
+                extract_version = max(extract_version, raw.extract_version)
 
             extra = b''
 
@@ -205,50 +564,83 @@ class ZipStream(object):
 
             header = struct.pack(
                 STRUCT_FILE_HEADER, STRING_FILE_HEADER, extract_version, 0,
-                flag_bits, ZIP_MODE_STORED, dostime, dosdate, 0, 0, 0,
+                flag_bits, compress_type, dostime, dosdate, 0, 0, 0,
                 len(filename), len(extra))
 
-            yield self._incr(header)
-            yield self._incr(filename)
-            yield self._incr(extra)
+            yield ctx.incr(header)
+            yield ctx.incr(filename)
+            yield ctx.incr(extra)
 
             file_crc = 0
             file_size = 0
+            compress_size = 0
+            body_size = zip_file.size if raw is None else raw.compress_size
 
-            if zip_file.create_fp is not None and self._calculate_size:
+            if zip_file.create_fp is not None and ctx.calculate_size:
                 file_size = zip_file.size
-                self._pos += file_size
+                compress_size = body_size
+                ctx.pos += body_size
+            elif cached is not None:
+                compress_size = len(cached.data)
+                file_size = compress_size if raw is None else zip_file.size
+                file_crc = cached.crc
+
+                for pos in range(0, compress_size, READ_CHUNK_SIZE):
+                    yield ctx.incr(cached.data[pos:pos + READ_CHUNK_SIZE])
             elif file_obj is not None:
-                while True:
-                    buf = file_obj.read(4096)
-                    if not buf:
-                        break
+                file_range = None
+                cache_bufs = [] if cache_key is not None else None
+
+                if ctx.copy_ranges and zip_file.crc is not None and \
+                        body_size is not None:
+                    file_range = get_file_range(file_obj, body_size)
+
+                if file_range is not None:
+                    compress_size = body_size
+                    ctx.pos += body_size
 
-                    if isinstance(buf, str):
-                        raise ZipFileBytesRequired(
-                            'File object should contain bytes')
+                    yield file_range
+                else:
+                    for buf in read_chunks(file_obj):
+                        compress_size = compress_size + len(buf)
 
-                    file_size = file_size + len(buf)
-                    file_crc = crc32(buf, file_crc) & 0xffffffff
+                        if raw is None:
+                            file_crc = crc32(buf, file_crc) & 0xffffffff
 
-                    yield self._incr(buf)
+                        cache_bufs = collect_cache_buf(
+                            self.cache, cache_bufs, buf, compress_size)
+
+                        yield ctx.incr(buf)
+
+                if raw is not None and compress_size != raw.compress_size:
+                    raise ZipStreamError(
+                        'Raw file data is truncated: %s' % filename)
+
+                if raw is not None or file_range is not None:
+                    file_crc = zip_file.crc
+                    file_size = zip_file.size
+                else:
+                    file_size = compress_size
+
+                if cache_bufs is not None and file_range is None:
+                    self.cache.put(cache_key, b''.join(cache_bufs), file_crc)
         finally:
             if hasattr(file_obj, 'close'):
                 file_obj.close()
 
-        is_zip64 = file_size > UINT32_MAX
+        is_zip64 = file_size > UINT32_MAX or compress_size > UINT32_MAX
 
         if is_zip64:
-            extract_version = ZIP_VERSION_45
+            extract_version = max(extract_version, ZIP_VERSION_45)
             data_descriptor = struct.pack(
                 STRUCT_DATA_DESCRIPTOR64, STRING_DATA_DESCRIPTOR, file_crc,
-                file_size, file_size)
+                compress_size, file_size)
         else:
             data_descriptor = struct.pack(
                 STRUCT_DATA_DESCRIPTOR, STRING_DATA_DESCRIPTOR, file_crc,
-                file_size, file_size)
+                compress_size, file_size)
 
-        yield self._incr(data_descriptor)
+        yield ctx.incr(data_descriptor)
 
         comment = b'' if zip_file.comment is None else zip_file.comment
 
@@ -276,62 +668,64 @@ class ZipStream(object):
             external_attr=external_attr,
             offset=offset,
             is_zip64=is_zip64,
+            compress_type=compress_type,
+            compress_size=compress_size,
         )
 
-        self._dir.append(dir_entry)
+        ctx.dir.append(dir_entry)
 
-    def _generate_dir_entry(self, entry):
+    def _generate_dir_entry(self, ctx, entry):
         extra = entry.extra
         file_size = entry.file_size
+        compress_size = entry.compress_size
         offset = entry.offset
         create_system = 0
         reserved = 0
-        compress_type = ZIP_MODE_STORED
         disk_number_start = 0
         internal_attr = 0
 
         central_dir_file_size = file_size
+        central_dir_compress_size = compress_size
         central_dir_offset = min(offset, UINT32_MAX)
 
         if entry.is_zip64:
             central_dir_file_size = UINT32_MAX
+            central_dir_compress_size = UINT32_MAX
 
             zip64_extra = struct.pack(
                 STRUCT_ZIP64_EXTRA, ZIP64_EXTRA_ID, ZIP64_EXTRA_SIZE,
-                file_size, file_size, offset)
+                file_size, compress_size, offset)
 
             extra += zip64_extra
 
         central_dir = struct.pack(
             STRUCT_CENTRAL_DIR, STRING_CENTRAL_DIR, entry.create_version,
             create_system, entry.extract_version, reserved, entry.flag_bits,
-            compress_type, entry.dostime, entry.dosdate, entry.file_crc,
-            central_dir_file_size, central_dir_file_size, len(entry.filename),
+            entry.compress_type, entry.dostime, entry.dosdate, entry.file_crc,
+            central_dir_compress_size, central_dir_file_size,
+            len(entry.filename),
             len(extra), len(entry.comment), disk_number_start, internal_attr,
             entry.external_attr, central_dir_offset)
 
-        yield self._incr(central_dir)
-        yield self._incr(entry.filename)
-        yield self._incr(extra)
-        yield self._incr(entry.comment)
-
-    def _generate_zip_file(self):
-        self._dir = []
-        self._pos = 0
+        yield ctx.incr(central_dir)
+        yield ctx.incr(entry.filename)
+        yield ctx.incr(extra)
+        yield ctx.incr(entry.comment)
 
-        for zip_file in self.files:
-            for chunk in self._generate_file(zip_file):
+    def _generate_zip_file(self, ctx):
+        for zip_file, opened in self._iter_opened_files(ctx):
+            for chunk in self._generate_file(ctx, zip_file, opened):
                 yield chunk
 
-        start = self._pos
+        start = ctx.pos
 
-        for entry in self._dir:
-            for chunk in self._generate_dir_entry(entry):
+        for entry in ctx.dir:
+            for chunk in self._generate_dir_entry(ctx, entry):
                 yield chunk
 
-        end = self._pos
+        end = ctx.pos
 
-        cent_dir_count = len(self._dir)
+        cent_dir_count = len(ctx.dir)
         cent_dir_size = end - start
         cent_dir_offset = start
 
@@ -342,13 +736,13 @@ class ZipStream(object):
                 ZIP_VERSION_45, 0, 0, cent_dir_count, cent_dir_count,
                 cent_dir_size, cent_dir_offset)
 
-            yield self._incr(zip64_end_rec)
+            yield ctx.incr(zip64_end_rec)
 
             zip64_loc_rec = struct.pack(
                 STRUCT_END_ARCHIVE64_LOCATOR, STRING_END_ARCHIVE64_LOCATOR, 0,
                 end, 1)
 
-            yield self._incr(zip64_loc_rec)
+            yield ctx.incr(zip64_loc_rec)
 
             cent_dir_count = UINT16_MAX
             cent_dir_size = UINT32_MAX
@@ -360,8 +754,188 @@ class ZipStream(object):
             STRUCT_END_ARCHIVE, STRING_END_ARCHIVE, 0, 0, cent_dir_count,
             cent_dir_count, cent_dir_size, cent_dir_offset, len(eocd_comment))
 
-        yield self._incr(endrec)
-        yield self._incr(eocd_comment)
+        yield ctx.incr(endrec)
+        yield ctx.incr(eocd_comment)
+
+
+def read_chunks(file_obj):
+    while True:
+        buf = file_obj.read(READ_CHUNK_SIZE)
+        if not buf:
+            return
+
+        if isinstance(buf, str):
+            raise ZipFileBytesRequired('File object should contain bytes')
+
+        yield buf
+
+
+def collect_cache_buf(cache, cache_bufs, buf, size):
+    # stop collecting once the file is too large to be cached
+    if cache_bufs is None or size > cache.max_file_size:
+        return None
+
+    cache_bufs.append(buf)
+
+    return cache_bufs
+
+
+def close_opened_file(opened):
+    if opened is not None and hasattr(opened.file_obj, 'close'):
+        opened.file_obj.close()
+
+
+def check_opened_size(zip_file, opened):
+    if zip_file.size is None or zip_file.raw is not None:
+        return
+
+    if opened.cached is not None:
+        size = len(opened.cached.data)
+    else:
+        size = get_source_size(opened.file_obj)
+
+    if size is not None and size != zip_file.size:
+        raise ZipFileSizeMismatch(
+            'ZipFile.size is %d but the file has %d bytes: %s' % (
+                zip_file.size, size, zip_file.filename))
+
+
+def get_source_size(file_obj):
+    try:
+        st = os.fstat(file_obj.fileno())
+
+        if stat.S_ISREG(st.st_mode):
+            return st.st_size - file_obj.tell()
+    except (AttributeError, IOError, OSError, ValueError):
+        pass
+
+    if hasattr(file_obj, 'seekable') and not file_obj.seekable():
+        return None
+
+    try:
+        pos = file_obj.tell()
+        file_obj.seek(0, os.SEEK_END)
+        end = file_obj.tell()
+        file_obj.seek(pos)
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+
+    return end - pos
+
+
+def order_by_host(files):
+    groups = OrderedDict()
+
+    for zip_file in files:
+        groups.setdefault(zip_file.host, []).append(zip_file)
+
+    return [zip_file for group in groups.values() for zip_file in group]
+
+
+def imap_unordered(func, items, workers, discard):
+    """
+    Call ``func`` for ``items`` on ``workers`` threads and yield
+    ``(item, result, error)`` in completion order. At most ``workers`` items
+    are in progress or waiting to be yielded at once. Results that are never
+    yielded (e.g. the generator is closed) are passed to ``discard`` before
+    ``close()`` returns.
+    """
+    if workers < 1:
+        raise ValueError('Workers should be positive: %s' % workers)
+
+    return iter_unordered(func, iter(items), workers, discard)
+
+
+def iter_unordered(func, items, workers, discard):
+    results = Queue()
+    slots = threading.Semaphore(workers)
+    lock = threading.Lock()
+    closed = []
+    done = object()
+
+    def next_item():
+        with lock:
+            if closed:
+                return done
+
+            return next(items, done)
+
+    def run():
+        while True:
+            slots.acquire()
+
+            item = next_item()
+
+            if item is done:
+                results.put(done)
+                return
+
+            try:
+                result = (item, func(item), None)
+            except BaseException as e:  # pylint: disable=broad-except
+                result = (item, None, e)
+
+            with lock:
+                if not closed:
+                    results.put(result)
+                    continue
+
+            discard(result)
+
+    threads = [threading.Thread(target=run) for _ in range(workers)]
+
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    running = workers
+
+    try:
+        while running:
+            result = results.get()
+
+            if result is done:
+                running -= 1
+                continue
+
+            slots.release()
+
+            yield result
+    finally:
+        with lock:
+            closed.append(True)
+
+            leftovers = []
+
+            while not results.empty():
+                leftovers.append(results.get())
+
+        # wake up the workers waiting for a slot so that they can exit
+        for _ in range(workers):
+            slots.release()
+
+        for result in leftovers:
+            if result is not done:
+                discard(result)
+
+        # files still being opened are discarded by the workers themselves
+        for thread in threads:
+            thread.join()
+
+
+def get_file_timetuple(zip_file, deterministic):
+    file_dt = zip_file.datetime
+
+    if isinstance(file_dt, datetime.datetime):
+        file_dt = file_dt.timetuple()
+
+    if file_dt is None:
+        if deterministic:
+            file_dt = DETERMINISTIC_DATETIME
+        else:
+            file_dt = time.localtime(time.time())
+
+    return file_dt
 
 
 def encode_filename_flags(filename, flag_bits):
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+"""
+archive
+~~~~~~~~~~~~~~~
+Raw pass-through of entries of existing ZIP archives.
+"""
+
+# pylint: disable=missing-docstring
+
+from __future__ import unicode_literals
+
+import datetime
+import struct
+import zipfile
+
+from .exceptions import ZipStreamError, ZipFileEncrypted
+from .structs import (
+    ZipFile, RawZipEntry, FLAG_ENCRYPTED, STRUCT_FILE_HEADER,
+    STRING_FILE_HEADER,
+)
+
+__all__ = ['archive_entries', 'archive_entry']
+
+
+class ArchiveEntryReader(object):
+    def __init__(self, fp, size):
+        self.fp = fp
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+
+        if not size:
+            return b''
+
+        buf = self.fp.read(size)
+        self.remaining -= len(buf)
+
+        return buf
+
+    def tell(self):
+        return self.fp.tell()
+
+    def fileno(self):
+        return self.fp.fileno()
+
+    def close(self):
+        if hasattr(self.fp, 'close'):
+            self.fp.close()
+
+
+def archive_entries(create_archive_fp, names=None):
+    """
+    Return ZipFiles for entries (all or ``names``) of an existing ZIP archive.
+    Their compressed data is copied as-is, without decompressing,
+    recompressing or calculating CRC. ``create_archive_fp`` must return a new
+    seekable file object of the archive on every call. Use ``_replace()`` on
+    the returned ZipFiles to rename them.
+    """
+    archive_fp = create_archive_fp()
+
+    try:
+        infos = zipfile.ZipFile(archive_fp).infolist()
+    finally:
+        if hasattr(archive_fp, 'close'):
+            archive_fp.close()
+
+    if names is not None:
+        infos_by_name = dict((info.filename, info) for info in infos)
+        infos = [infos_by_name[name] for name in names]
+
+    return [archive_entry(create_archive_fp, info) for info in infos]
+
+
+def archive_entry(create_archive_fp, info):
+    if info.flag_bits & FLAG_ENCRYPTED:
+        raise ZipFileEncrypted(
+            'Encrypted archive entries are not supported: %s' % info.filename)
+
+    def create_fp():
+        return open_archive_entry(
+            create_archive_fp(), info.header_offset, info.compress_size)
+
+    try:
+        file_dt = datetime.datetime(*info.date_time)
+    except ValueError:
+        file_dt = None
+
+    return ZipFile(
+        filename=info.filename,
+        size=info.file_size,
+        create_fp=create_fp,
+        datetime=file_dt,
+        comment=info.comment or None,
+        crc=info.CRC,
+        raw=RawZipEntry(
+            compress_type=info.compress_type,
+            compress_size=info.compress_size,
+            flag_bits=info.flag_bits,
+            extract_version=info.extract_version,
+        ),
+    )
+
+
+def open_archive_entry(fp, header_offset, compress_size):
+    try:
+        fp.seek(header_offset)
+
+        header = fp.read(struct.calcsize(STRUCT_FILE_HEADER))
+
+        if len(header) != struct.calcsize(STRUCT_FILE_HEADER) or \
+                header[:4] != STRING_FILE_HEADER:
+            raise ZipStreamError('Bad local file header')
+
+        header = struct.unpack(STRUCT_FILE_HEADER, header)
+
+        fp.seek(header_offset + struct.calcsize(STRUCT_FILE_HEADER) +
+                header[10] + header[11])
+    except Exception:
+        if hasattr(fp, 'close'):
+            fp.close()
+
+        raise
+
+    return ArchiveEntryReader(fp, compress_size)
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+"""
+cache
+~~~~~~~~~~~~~~~
+SourceCache keeps small files in memory between ZipStreams.
+"""
+
+# pylint: disable=missing-docstring
+
+from __future__ import unicode_literals
+
+from collections import namedtuple, OrderedDict
+import threading
+
+__all__ = ['SourceCache', 'CachedFile']
+
+CACHE_MAX_FILE_SIZE = 64 * 1024
+
+CachedFile = namedtuple('CachedFile', ['data', 'crc'])
+
+
+class SourceCache(object):
+    """
+    SourceCache keeps data and CRC of small files in memory, keyed by
+    ``ZipFile.source_id`` and ``ZipFile.version`` (files without both are not
+    cached). Least recently used files are evicted once more than
+    ``max_size`` bytes are cached. Files larger than ``max_file_size``
+    (64 KiB by default) are not cached, which also bounds the memory a single
+    download buffers while filling the cache.
+
+    By default a cache hit only saves the body transfer: ``create_fp`` is
+    still called (and closed) for cached files so that ZipFileSkip is
+    respected. To avoid opening sources, pass ``check_skip(zip_file)``, which
+    may raise ZipFileSkip, or ``ignore_skip=True`` to serve cached files even
+    if their ``create_fp`` would raise ZipFileSkip now.
+    """
+
+    def __init__(self, max_size, max_file_size=None, check_skip=None,
+                 ignore_skip=False):
+        self.max_size = max_size
+        if max_file_size is None:
+            max_file_size = CACHE_MAX_FILE_SIZE
+
+        self.max_file_size = min(max_file_size, max_size)
+        self.check_skip = check_skip
+        self.ignore_skip = ignore_skip
+
+        self._lock = threading.Lock()
+        self._files = OrderedDict()
+        self._size = 0
+
+    def get(self, key):
+        with self._lock:
+            cached = self._files.pop(key, None)
+
+            if cached is not None:
+                self._files[key] = cached
+
+            return cached
+
+    def put(self, key, data, crc):
+        if len(data) > self.max_file_size:
+            return
+
+        with self._lock:
+            old = self._files.pop(key, None)
+
+            if old is not None:
+                self._size -= len(old.data)
+
+            self._files[key] = CachedFile(data=data, crc=crc)
+            self._size += len(data)
+
+            while self._size > self.max_size:
+                _, evicted = self._files.popitem(last=False)
+                self._size -= len(evicted.data)
+
+    def size(self):
+        with self._lock:
+            return self._size
+
+    def __len__(self):
+        with self._lock:
+            return len(self._files)
@@ -14,7 +14,7 @@ Copied from requests.
 
 import sys
 
-__all__ = ['IS_PY2', 'IS_PY3', 'str', 'BytesIO']
+__all__ = ['IS_PY2', 'IS_PY3', 'str', 'BytesIO', 'Queue']
 
 # -------
 # Pythons
@@ -31,10 +31,12 @@ IS_PY3 = (_VER[0] == 3)
 
 if IS_PY2:
     from StringIO import StringIO as BytesIO
+    from Queue import Queue
 
     str = unicode
 
 elif IS_PY3:
     from io import BytesIO
+    from queue import Queue
 
     str = str
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+"""
+exceptions
+~~~~~~~~~~~~~~~
+Exceptions raised by ZipStreamer.
+"""
+
+# pylint: disable=missing-docstring
+
+from __future__ import unicode_literals
+
+
+class ZipStreamError(Exception):
+    pass
+
+
+class FileNameTooLong(ZipStreamError):
+    pass
+
+
+class ZipFileSizeRequired(ZipStreamError):
+    pass
+
+
+# kept for backwards compatibility, ZipStream can now be used concurrently
+class ZipFileInProgress(ZipStreamError):
+    pass
+
+
+class ZipFileBytesRequired(ZipStreamError):
+    pass
+
+
+class ZipFileVersionRequired(ZipStreamError):
+    pass
+
+
+class ZipFileDatetimeRequired(ZipStreamError):
+    pass
+
+
+class ZipFileEncrypted(ZipStreamError):
+    pass
+
+
+class ZipFileSizeMismatch(ZipStreamError):
+    pass
+
+
+class ZipFileSkip(Exception):
+    """
+    ZipFileSkip can be used to skip the file when ``create_fp`` is called.
+    It should not be used when ``.size()`` is used, unless the files are
+    opened ahead with ``.preflight()``.
+    """
+
+    def __init__(self):
+        super(ZipFileSkip, self).__init__('Skip the file')
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+"""
+fdio
+~~~~~~~~~~~~~~~
+Writing to file descriptors with writev and copy_file_range.
+"""
+
+# pylint: disable=missing-docstring
+
+from __future__ import unicode_literals
+
+from collections import namedtuple
+import errno
+import os
+import stat
+
+from .exceptions import ZipStreamError
+
+__all__ = ['FdWriter', 'FileRange', 'get_file_range']
+
+WRITE_BUFFER_SIZE = 64 * 1024
+COPY_CHUNK_SIZE = 1024 * 1024
+IOV_MAX = 1024
+
+# copy_file_range errors after which we fall back to read/write (EBADF is
+# returned when the destination is opened with O_APPEND)
+COPY_FILE_RANGE_FALLBACK_ERRNOS = frozenset(
+    getattr(errno, name) for name in (
+        'EXDEV', 'ENOSYS', 'EINVAL', 'EOPNOTSUPP', 'ENOTSUP', 'EBADF')
+    if hasattr(errno, name))
+
+
+FileRange = namedtuple('FileRange', ['fd', 'offset', 'count'])
+
+
+class FdWriter(object):
+    def __init__(self, fd, buffer_size=WRITE_BUFFER_SIZE):
+        self.fd = fd
+        self.buffer_size = buffer_size
+
+        self._buffers = []
+        self._buffered = 0
+
+    def write(self, buf):
+        if not buf:
+            return
+
+        self._buffers.append(buf)
+        self._buffered += len(buf)
+
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        buffers = self._buffers
+
+        self._buffers = []
+        self._buffered = 0
+
+        write_all(self.fd, buffers)
+
+    def copy(self, file_range):
+        self.flush()
+
+        copy_range(file_range.fd, self.fd, file_range.offset, file_range.count)
+
+
+def get_file_range(file_obj, size):
+    if not hasattr(file_obj, 'fileno'):
+        return None
+
+    try:
+        fd = file_obj.fileno()
+        offset = file_obj.tell()
+        st = os.fstat(fd)
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+
+    if not stat.S_ISREG(st.st_mode) or st.st_size - offset < size:
+        return None
+
+    return FileRange(fd=fd, offset=offset, count=size)
+
+
+def write_all(fd, buffers):
+    writev = getattr(os, 'writev', None)
+
+    if writev is None:
+        data = memoryview(b''.join(buffers))
+
+        while data:
+            data = data[os.write(fd, data):]
+
+        return
+
+    i = 0
+
+    while i < len(buffers):
+        written = writev(fd, buffers[i:i + IOV_MAX])
+
+        while written:
+            buf_size = len(buffers[i])
+
+            if written >= buf_size:
+                written -= buf_size
+                i += 1
+            else:
+                buffers[i] = memoryview(buffers[i])[written:]
+                written = 0
+
+
+def copy_range(src_fd, dst_fd, offset, count):
+    copy_file_range = getattr(os, 'copy_file_range', None)
+
+    while count:
+        if copy_file_range is not None:
+            try:
+                copied = copy_file_range(src_fd, dst_fd, count, offset)
+            except OSError as e:
+                if e.errno not in COPY_FILE_RANGE_FALLBACK_ERRNOS:
+                    raise
+
+                copy_file_range = None
+                continue
+        else:
+            buf = pread(src_fd, min(count, COPY_CHUNK_SIZE), offset)
+            write_all(dst_fd, [buf])
+            copied = len(buf)
+
+        if not copied:
+            raise ZipStreamError('File is shorter than ZipFile.size')
+
+        offset += copied
+        count -= copied
+
+
+def pread(fd, size, offset):
+    if hasattr(os, 'pread'):
+        return os.pread(fd, size, offset)
+
+    os.lseek(fd, offset, os.SEEK_SET)
+
+    return os.read(fd, size)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+"""
+ratelimit
+~~~~~~~~~~~~~~~
+Token bucket rate limiting of generated data.
+"""
+
+# pylint: disable=missing-docstring
+
+from __future__ import unicode_literals
+
+import threading
+import time
+
+__all__ = ['RateLimiter']
+
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+class RateLimiter(object):
+    """
+    Token bucket limiting throughput to ``rate`` bytes per second with bursts
+    of up to ``burst`` bytes (defaults to ``rate``). Pass it to ZipStreams as
+    ``rate_limiter`` to share a budget between them.
+    """
+
+    def __init__(self, rate, burst=None, clock=monotonic, sleep=time.sleep):
+        if rate <= 0:
+            raise ValueError('Rate should be positive: %s' % rate)
+
+        if burst is not None and burst <= 0:
+            raise ValueError('Burst should be positive: %s' % burst)
+
+        self.rate = rate
+        self.burst = rate if burst is None else burst
+        self.clock = clock
+        self.sleep = sleep
+
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._updated = clock()
+
+    def reserve(self, size):
+        """
+        Take ``size`` tokens and return the number of seconds to wait before
+        they are available.
+        """
+        with self._lock:
+            now = self.clock()
+
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= size
+
+            return max(0, -self._tokens / float(self.rate))
+
+    def throttle(self, size):
+        delay = self.reserve(size)
+
+        if delay > 0:
+            self.sleep(delay)
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+"""
+scheduler
+~~~~~~~~~~~~~~~
+SourceScheduler limits how many sources are open at once.
+"""
+
+# pylint: disable=missing-docstring
+
+from __future__ import unicode_literals
+
+import contextlib
+from collections import deque, OrderedDict
+import threading
+
+__all__ = ['SourceScheduler', 'ScheduledFile']
+
+
+class SchedulerTicket(object):  # pylint: disable=too-few-public-methods
+    def __init__(self, host):
+        self.host = host
+        self.granted = False
+
+
+class SourceScheduler(object):  # pylint: disable=too-many-instance-attributes
+    """
+    SourceScheduler limits how many sources are open at once, in total
+    (``max_concurrency``) and per ``ZipFile.host`` (``max_per_host``), across
+    all ZipStreams that share it. A slot is taken before ``create_fp`` is
+    called and released when the file object is closed. Waiting streams are
+    served round-robin.
+
+    ``pool(host)`` returns a per-host object created with
+    ``pool_factory(host)`` (e.g. a connection pool) that sources can reuse.
+    """
+
+    def __init__(self, max_concurrency=None, max_per_host=None,
+                 pool_factory=None):
+        self.max_concurrency = max_concurrency
+        self.max_per_host = max_per_host
+        self.pool_factory = pool_factory
+
+        self._cond = threading.Condition()
+        self._active = 0
+        self._active_by_host = {}
+        self._waiting = OrderedDict()
+        self._pools = {}
+
+    def acquire(self, stream, host=None):
+        ticket = SchedulerTicket(host)
+
+        with self._cond:
+            self._waiting.setdefault(stream, deque()).append(ticket)
+            self._dispatch()
+
+            while not ticket.granted:
+                self._cond.wait()
+
+    def release(self, host=None):
+        with self._cond:
+            self._active -= 1
+            self._active_by_host[host] -= 1
+
+            if not self._active_by_host[host]:
+                del self._active_by_host[host]
+
+            self._dispatch()
+
+    def active(self, host=None):
+        """
+        Return the number of taken slots, in total or for ``host``.
+        """
+        with self._cond:
+            if host is None:
+                return self._active
+
+            return self._active_by_host.get(host, 0)
+
+    def waiting(self):
+        """
+        Return the number of ``acquire()`` calls waiting for a slot.
+        """
+        with self._cond:
+            return sum(len(tickets) for tickets in self._waiting.values())
+
+    @contextlib.contextmanager
+    def slot(self, stream, host=None):
+        self.acquire(stream, host)
+
+        try:
+            yield
+        finally:
+            self.release(host)
+
+    def pool(self, host):
+        if self.pool_factory is None:
+            return None
+
+        with self._cond:
+            if host not in self._pools:
+                self._pools[host] = self.pool_factory(host)
+
+            return self._pools[host]
+
+    def close(self):
+        with self._cond:
+            pools = list(self._pools.values())
+            self._pools = {}
+
+        for pool in pools:
+            if hasattr(pool, 'close'):
+                pool.close()
+
+    def _dispatch(self):
+        # grant at most one ticket per stream per pass and move the stream to
+        # the end of the queue so that streams are served round-robin
+        granted = False
+
+        while self._can_grant():
+            stream = self._next_stream()
+
+            if stream is None:
+                break
+
+            tickets = self._waiting.pop(stream)
+            ticket = tickets.popleft()
+
+            if tickets:
+                self._waiting[stream] = tickets
+
+            ticket.granted = True
+            self._active += 1
+            self._active_by_host[ticket.host] = \
+                self._active_by_host.get(ticket.host, 0) + 1
+            granted = True
+
+        if granted:
+            self._cond.notify_all()
+
+    def _next_stream(self):
+        for stream, tickets in self._waiting.items():
+            if self._can_grant(tickets[0].host):
+                return stream
+
+        return None
+
+    def _can_grant(self, host=None):
+        if self.max_concurrency is not None and \
+                self._active >= self.max_concurrency:
+            return False
+
+        if host is not None and self.max_per_host is not None and \
+                self._active_by_host.get(host, 0) >= self.max_per_host:
+            return False
+
+        return True
+
+
+class ScheduledFile(object):
+    """
+    Wraps a file object returned by ``create_fp`` and holds its
+    SourceScheduler slot until it is closed.
+    """
+
+    def __init__(self, file_obj, scheduler, host):
+        self.file_obj = file_obj
+        self.scheduler = scheduler
+        self.host = host
+
+        self._released = False
+
+    def __getattr__(self, name):
+        return getattr(self.file_obj, name)
+
+    def release(self):
+        """
+        Release the slot without closing the file.
+        """
+        if not self._released:
+            self._released = True
+            self.scheduler.release(self.host)
+
+    def close(self):
+        try:
+            if hasattr(self.file_obj, 'close'):
+                self.file_obj.close()
+        finally:
+            self.release()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+"""
+structs
+~~~~~~~~~~~~~~~
+ZIP format constants and the ZipFile tuples.
+"""
+
+# pylint: disable=missing-docstring
+
+from __future__ import unicode_literals
+
+from collections import namedtuple
+
+ZIP_MODE_STORED = 0
+
+FLAG_ENCRYPTED = 0x1
+FLAG_COMPRESSION_OPTIONS = 0x6  # e.g. deflate level, kept for raw entries
+
+STRUCT_FILE_HEADER = '<4s2B4HL2L2H'
+STRING_FILE_HEADER = b'PK\x03\x04'
+
+STRUCT_DATA_DESCRIPTOR = '<4sLLL'
+STRUCT_DATA_DESCRIPTOR64 = '<4sLQQ'
+# de-facto standard, required by OS X Finder
+STRING_DATA_DESCRIPTOR = b'PK\x07\x08'
+
+STRUCT_CENTRAL_DIR = '<4s4B4HL2L5H2L'
+STRING_CENTRAL_DIR = b'PK\x01\x02'
+
+STRUCT_ZIP64_EXTRA = '<2H3Q'
+ZIP64_EXTRA_ID = 0x0001  # Zip64 extended information
+ZIP64_EXTRA_SIZE = 24  # 3x uint64
+
+STRUCT_EXT_TIME_EXTRA = '<2HBL'
+EXT_TIME_EXTRA_ID = 0x5455  # Extended timestamp
+EXT_TIME_EXTRA_SIZE = 5  # uint8 + uint32
+EXT_TIME_EXTRA_FLAGS = 1  # ModTime
+
+STRUCT_END_ARCHIVE = '<4s4H2LH'
+STRING_END_ARCHIVE = b'PK\x05\x06'
+
+STRUCT_END_ARCHIVE64_LOCATOR = '<4sLQL'
+STRING_END_ARCHIVE64_LOCATOR = b'PK\x06\x07'
+
+STRUCT_END_ARCHIVE64 = '<4sQ2H2L4Q'
+STRING_END_ARCHIVE64 = b'PK\x06\x06'
+
+UINT16_MAX = (1 << 16) - 1
+UINT32_MAX = (1 << 32) - 1
+
+ZIP_VERSION_20 = 20  # 2.0
+ZIP_VERSION_45 = 45  # 4.5 (reads and writes zip64 archives)
+
+ZipFile = namedtuple('ZipFile', [
+    'filename', 'size', 'create_fp', 'datetime', 'comment', 'crc', 'version',
+    'host', 'raw', 'source_id',
+])
+# crc (CRC-32 of the file contents) and version (any bytes, str or int that
+# changes when the contents change) are optional. When crc is known together
+# with size, write_to() can copy regular files without reading them. etag()
+# requires crc or version for every file with create_fp. host identifies the
+# upstream storage host of create_fp for SourceScheduler limits. raw is a
+# RawZipEntry when create_fp returns already compressed data (see
+# archive_entries()). source_id identifies the source of create_fp together
+# with version for SourceCache.
+ZipFile.__new__.__defaults__ = (None, None, None, None, None)
+
+RawZipEntry = namedtuple('RawZipEntry', [
+    'compress_type', 'compress_size', 'flag_bits', 'extract_version',
+])
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+"""
+wsgi
+~~~~~~~~~~~~~~~
+Helpers for serving a ZipStream over HTTP with ETag revalidation.
+"""
+
+# pylint: disable=missing-docstring
+
+from __future__ import unicode_literals
+
+from . import ZipStreamError, ZipFileSizeRequired
+
+__all__ = ['etag_matches', 'wsgi_response']
+
+
+def etag_matches(if_none_match, etag):
+    """
+    Return True if the ``If-None-Match`` header value matches ``etag``
+    (weak comparison, as required for If-None-Match).
+    """
+    if not if_none_match:
+        return False
+
+    if if_none_match.strip() == '*':
+        return True
+
+    etag = strip_weak(etag)
+
+    return any(
+        strip_weak(tag.strip()) == etag for tag in if_none_match.split(','))
+
+
+def strip_weak(etag):
+    if etag.startswith('W/'):
+        return etag[2:]
+
+    return etag
+
+
+def wsgi_response(zip_stream, environ, start_response, headers=None,
+                  no_skip=False):
+    """
+    Serve ``zip_stream`` from a WSGI application.
+
+    ``ZipStream.size()`` and ``ZipStream.etag()`` still count files that
+    raise ZipFileSkip, so Content-Length and ETag are only sent if
+    ``no_skip`` is set (no file raises ZipFileSkip) or the stream was
+    returned by ``ZipStream.preflight()``. Then a matching
+    ``If-None-Match`` is answered with ``304 Not Modified``. ETag is left
+    out if it cannot be calculated and Content-Length if a size is missing.
+    ``zip_stream`` is closed if its body is not sent (304 and HEAD).
+    """
+    method = environ.get('REQUEST_METHOD', 'GET')
+    no_skip = no_skip or zip_stream.preflighted
+
+    etag = get_etag(zip_stream) if no_skip else None
+
+    response_headers = []
+
+    if etag is not None:
+        response_headers.append(('ETag', etag))
+
+    response_headers.extend(headers or [])
+
+    if etag is not None and method in ('GET', 'HEAD') and \
+            etag_matches(environ.get('HTTP_IF_NONE_MATCH'), etag):
+        start_response(str('304 Not Modified'), native_headers(
+            response_headers))
+        zip_stream.close()
+        return []
+
+    response_headers.append(('Content-Type', 'application/zip'))
+
+    if no_skip:
+        try:
+            response_headers.append(
+                ('Content-Length', str(zip_stream.size())))
+        except ZipFileSizeRequired:
+            pass
+
+    start_response(str('200 OK'), native_headers(response_headers))
+
+    if method == 'HEAD':
+        zip_stream.close()
+        return []
+
+    return zip_stream.generate()
+
+
+def get_etag(zip_stream):
+    # e.g. ZipFileVersionRequired or ZipFileDatetimeRequired
+    try:
+        return zip_stream.etag()
+    except ZipStreamError:
+        return None
+
+
+def native_headers(headers):
+    # WSGI requires native strings for status and headers
+    return [(str(key), str(value)) for key, value in headers]